@@ -1,133 +1,249 @@
+import sys
 import numpy as np
-from collections import namedtuple
-from typing import Set
+from numba import njit
+from typing import Optional
 from time import sleep
 
-Position = namedtuple("Position", "x y")
+# Offsets (dy, dx) of the 8 squares surrounding a square, the square itself is left out
+NEIGHBOUR_OFFSETS = np.array([(-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, -1), (1, 0), (1, 1)], dtype=np.int32)
+
+# Weight of each tier, a wall square surrounded by n other walls is in tier n+1 and weighs 1, 2+1, 3+2+1, ... up to
+# 8+7+6+5+4+3+2+1 for 7 surrounding walls while tier 0 marks squares which can't be 'dug out' next
+WEIGHT_TIERS = np.array([0, 1, 3, 6, 10, 15, 21, 28, 36], dtype=np.int64)
+
+# Frontiers up to this size are sampled with a plain linear scan, larger ones first scan the sums of blocks of this many
+# active slots and then only the chosen block
+BLOCK_SIZE = 64
+
+# Characters used to display the map, indexed by the flag of each square ('#' for walls and '.' for empty space)
+MAP_SYMBOLS = np.frombuffer(b'#.', dtype=np.uint8)
+
+# Characters used to display the weights, indexed by the weight tier of each square
+WEIGHT_SYMBOLS = np.frombuffer(b' 12345678', dtype=np.uint8)
+
+
+@njit(cache=True, boundscheck=False)
+def update_neighbourhood_weights(empty: np.ndarray, weights: np.ndarray, wall_counts: np.ndarray, x: int, y: int,
+                                 wall_xs: np.ndarray, wall_ys: np.ndarray) -> int:
+    """
+    Sets the weight tier of the dug out square (x, y) to 0 and reassigns the tiers of the wall squares adjacent to it
+
+    Every square surrounding (x, y) has one wall less around it, so its count in wall_counts is decremented and the
+    tier of an adjacent wall is assigned straight from its updated count, whether it had a weight before or not
+
+    The positions of the adjacent walls are written into wall_xs and wall_ys (at most 8 of them) and their number is
+    returned, so that the caller knows which weights have changed
+    """
+
+    height, width = empty.shape
+
+    weights[y, x] = 0
+
+    num_walls = 0
+    for k in range(NEIGHBOUR_OFFSETS.shape[0]):
+        offset_y, offset_x = y + NEIGHBOUR_OFFSETS[k, 0], x + NEIGHBOUR_OFFSETS[k, 1]
+        if not (0 <= offset_x < width and 0 <= offset_y < height):
+            continue
+        wall_counts[offset_y, offset_x] -= 1
+        if not empty[offset_y, offset_x]:
+            wall_xs[num_walls], wall_ys[num_walls] = offset_x, offset_y
+            num_walls += 1
+            weights[offset_y, offset_x] = wall_counts[offset_y, offset_x] + 1
+
+    return num_walls
+
+
+@njit(cache=True)
+def sample_weighted(weights: np.ndarray, target: int) -> int:
+    """
+    Returns an index into weights chosen with probability proportional to its weight, given an integer target drawn
+    uniformly from [0, sum of the weights)
+
+    The weights are accumulated in a single linear scan which stops as soon as the running sum passes the target, so
+    no cumulative array is built at all
+    """
+
+    running_sum = 0
+    for i in range(weights.size):
+        running_sum += weights[i]
+        if running_sum > target:
+            return i
+
+    return weights.size - 1
+
+
+@njit(cache=True)
+def sample_weighted_blocks(weights: np.ndarray, block_weights: np.ndarray, target: int) -> int:
+    """
+    Returns an index into weights chosen with probability proportional to its weight, given an integer target drawn
+    uniformly from [0, sum of the weights)
+
+    The block holding the target is found by scanning the sums of consecutive blocks of BLOCK_SIZE weights first, so
+    only about len(weights) / BLOCK_SIZE + BLOCK_SIZE weights are visited instead of all of them
+    """
+
+    block = 0
+    while target >= block_weights[block]:
+        target -= block_weights[block]
+        block += 1
+
+    start = block * BLOCK_SIZE
+    return start + sample_weighted(weights[start:start + BLOCK_SIZE], target)
 
 
 class WeightDiffusionMapGenerator:
-    def __init__(self, width: int, height: int) -> None:
+    def __init__(self, width: int, height: int, seed: Optional[int] = None) -> None:
         """
-        Initialises the map generator, represented by two numpy 2D arrays of the shape (width, height)
+        Initialises the map generator, represented by two numpy 2D arrays of the shape (height, width) which are
+        indexed as [y, x] so that every row of the map is contiguous in memory
+
+        One array holds flags corresponding to the state of each square in the grid (where empty spaces are flagged
+        with 1 and walls are flagged with 0) while the other array holds weights which are needed to determine the next
+        square to be 'dug out' in the sequential process
 
-        One array holds boolean values corresponding to the state of each square in the grid (where empty spaces are
-        flagged with True and walls are flagged with False) while the other array holds weights which are needed to
-        determine the next square to be 'dug out' in the sequential process
+        The weights are stored as small tier indices into WEIGHT_TIERS and only expanded for the active frontier
+
+        Random choices are drawn from a numpy Generator created from the optional seed, so a map can be reproduced
         """
 
-        self.__empty = np.full(shape=(width, height), fill_value=False, order='F', dtype=bool)
-        self.__weights = np.full(shape=(width, height), fill_value=0, order='F', dtype=int)
+        self.__empty = np.full(shape=(height, width), fill_value=0, dtype=np.uint8)
+        self.__weights = np.full(shape=(height, width), fill_value=0, dtype=np.uint8)
 
         # The width and height are stored for a more convenient access
         self.__width, self.__height = width, height
 
+        self.__rng = np.random.default_rng(seed)
+
+        # Number of walls surrounding each square, starting with every square within bounds (3 for corners, 5 for
+        # edges and 8 otherwise) and decremented as the squares around it are 'dug out'
+        rows = np.arange(height)
+        columns = np.arange(width)
+        neighbouring_rows = 1 + (rows > 0) + (rows < height - 1)
+        neighbouring_columns = 1 + (columns > 0) + (columns < width - 1)
+        self.__wall_counts = (np.outer(neighbouring_rows, neighbouring_columns) - 1).astype(np.int8)
+
+        # Squares with a nonzero weight (the frontier) are kept as flat indices alongside their weights in the first
+        # __num_active slots, so that choosing the next square only has to look at squares which can be dug out
+        self.__active_indices = np.empty(shape=width * height, dtype=np.int64)
+        self.__active_weights = np.empty(shape=width * height, dtype=np.int64)
+        self.__active_slots = np.full(shape=width * height, fill_value=-1, dtype=np.int64)
+        self.__num_active = 0
+
+        # Sum of all weights, kept up to date by the frontier bookkeeping instead of reducing the grid on every dig
+        self.__weight_sum = 0
+
+        # Sums of the active weights in every block of BLOCK_SIZE consecutive slots, used to sample large frontiers
+        self.__block_weights = np.zeros(shape=(width * height) // BLOCK_SIZE + 1, dtype=np.int64)
+
+        # Positions of the walls adjacent to the last dug out square, filled in by update_neighbourhood_weights
+        self.__wall_xs = np.empty(shape=8, dtype=np.int32)
+        self.__wall_ys = np.empty(shape=8, dtype=np.int32)
+
+        # Character buffer for displaying the map, every row ends with an extra column holding the line break and the
+        # flat view without the very last line break is what gets serialised
+        self.__frame = np.full(shape=(height, width + 1), fill_value=ord('\n'), dtype=np.uint8)
+        self.__frame_text = self.__frame.reshape(-1)[:-1]
+
         # Initialise the map with one empty space in the middle
-        self.__current_position = Position(self.__width // 2, self.__height // 2)
+        self.__current_x, self.__current_y = self.__width // 2, self.__height // 2
         self.__dig()
 
+    def __bytes__(self) -> bytes:
+        """
+        Returns an ASCII representation of the map, using '#' for walls and '.' for empty space
+
+        Every square is looked up in MAP_SYMBOLS at once, straight into the preallocated frame buffer
+        """
+
+        np.take(MAP_SYMBOLS, self.__empty, out=self.__frame[:, :-1])
+
+        return self.__frame_text.tobytes()
+
     def __str__(self) -> str:
         """
         Returns a string representation of the map, using '#' for walls and '.' for empty space
         """
 
-        return '\n'.join(''.join('#' if not value else '.' for value in col) for col in self.__empty.T)
+        return bytes(self).decode('ascii')
 
     @property
     def weights(self) -> str:
         """
-        Returns a string representation of the weights
-        """
-        def symbol(value: int) -> str:
-            if value == 0:
-                return ' '
-            elif value == 1:
-                return 'I'
-            elif value == 10:
-                return 'X'
-            elif value == 100:
-                return 'D'
-            elif value == 1000:
-                return 'M'
-            else:
-                return '?'
-        return '\n'.join(''.join(symbol(value) for value in col) for col in self.__weights.T)
-
-    def __neighbourhood_wall_positions(self, x: int, y: int) -> Set[Position]:
-        wall_positions = set()
-
-        for dx in [-1, 0, 1]:
-            for dy in [-1, 0, 1]:
-                offset_x, offset_y = x + dx, y + dy
-                in_bounds_offset_x = (0 <= offset_x < self.__width)
-                in_bounds_offset_y = (0 <= offset_y < self.__height)
-                in_bounds = in_bounds_offset_x and in_bounds_offset_y
-                if in_bounds and not self.__empty[offset_x, offset_y]:
-                    wall_positions.add(Position(offset_x, offset_y))
-
-        return wall_positions
-
-    def __init_neighbourhood_weights(self) -> Set[Position]:
-        """
-        Sets current square's weight to 0, the square has been dug out and is no longer considered when choosing next
-        square
-
-        Initialises weights for adjacent wall squares which could be 'dug out' next (previously 0)
-        """
-
-        x, y = self.__current_position.x, self.__current_position.y
-
-        self.__weights[x, y] = 0
-
-        wall_positions = self.__neighbourhood_wall_positions(x, y)
-
-        for wall_position in wall_positions:
-            if self.__weights[wall_position.x, wall_position.y] == 0:
-                self.__weights[wall_position.x, wall_position.y] = 1
-
-        return wall_positions
-
-    def __update_neighbourhood_weights(self, adjacent_walls: Set[Position]) -> None:
-        for adjacent_wall in adjacent_walls:
-            x, y = adjacent_wall.x, adjacent_wall.y
-            walls = self.__neighbourhood_wall_positions(x, y)
-            num_walls = len(walls) - 1  # We don't count the current wall
-
-            if num_walls == 0:
-                self.__weights[x, y] = 1
-            elif num_walls == 1:
-                self.__weights[x, y] = 2+1
-            elif num_walls == 2:
-                self.__weights[x, y] = 3+2+1
-            elif num_walls == 3:
-                self.__weights[x, y] = 4+3+2+1
-            elif num_walls == 4:
-                self.__weights[x, y] = 5+4+3+2+1
-            elif num_walls == 5:
-                self.__weights[x, y] = 6+5+4+3+2+1
-            elif num_walls == 6:
-                self.__weights[x, y] = 7+6+5+4+3+2+1
-            elif num_walls == 7:
-                self.__weights[x, y] = 8+7+6+5+4+3+2+1
+        Returns a string representation of the weights, using ' ' for squares without a weight and the weight tier
+        ('1' to '8') otherwise
+
+        Like the map itself, every square is looked up in WEIGHT_SYMBOLS at once, straight into the frame buffer
+        """
+
+        np.take(WEIGHT_SYMBOLS, self.__weights, out=self.__frame[:, :-1])
+
+        return self.__frame_text.tobytes().decode('ascii')
+
+    def __sync_active(self, x: int, y: int) -> None:
+        """
+        Brings the active frontier in line with the weight currently stored for a single square
+
+        Squares which got a nonzero weight are appended to the frontier, squares whose weight dropped to 0 are
+        swap-removed from it (the last active slot is moved into the freed one) so the active slots stay contiguous
+
+        The weight sum and the block sums are adjusted by the same differences as the active weights
+        """
+
+        weight = int(WEIGHT_TIERS[self.__weights[y, x]])
+
+        index = y * self.__width + x
+        slot = self.__active_slots[index]
+
+        previous_weight = int(self.__active_weights[slot]) if slot >= 0 else 0
+        self.__weight_sum += weight - previous_weight
+
+        if weight == 0:
+            if slot < 0:
+                return
+            last_slot = self.__num_active - 1
+            last_index = self.__active_indices[last_slot]
+            last_weight = self.__active_weights[last_slot]
+            self.__active_indices[slot] = last_index
+            self.__active_weights[slot] = last_weight
+            self.__active_slots[last_index] = slot
+            self.__active_slots[index] = -1
+            self.__num_active = last_slot
+            self.__block_weights[slot // BLOCK_SIZE] += last_weight - previous_weight
+            self.__block_weights[last_slot // BLOCK_SIZE] -= last_weight
+        elif slot < 0:
+            slot = self.__num_active
+            self.__active_indices[slot] = index
+            self.__active_weights[slot] = weight
+            self.__active_slots[index] = slot
+            self.__num_active += 1
+            self.__block_weights[slot // BLOCK_SIZE] += weight
+        else:
+            self.__active_weights[slot] = weight
+            self.__block_weights[slot // BLOCK_SIZE] += weight - previous_weight
 
     def __update_weights(self) -> None:
         """
-        Call the initial method to update neighbouring weights and update the remaining weights according to some
-        algorithm
+        Reweighs the neighbourhood of the current square and updates the active frontier for every changed square
         """
 
-        adjacent_walls = self.__init_neighbourhood_weights()
+        x, y = self.__current_x, self.__current_y
+
+        num_walls = update_neighbourhood_weights(
+            self.__empty, self.__weights, self.__wall_counts, x, y, self.__wall_xs, self.__wall_ys
+        )
 
-        self.__update_neighbourhood_weights(adjacent_walls)
+        self.__sync_active(x, y)
+        for i in range(num_walls):
+            self.__sync_active(self.__wall_xs[i], self.__wall_ys[i])
 
     def __dig(self) -> None:
         """
-        Set the boolean array for the 'dug out' square and call the method to update weights
+        Set the flag array for the 'dug out' square and call the method to update weights
         """
 
-        x, y = self.__current_position.x, self.__current_position.y
+        x, y = self.__current_x, self.__current_y
 
-        self.__empty[x, y] = True
+        self.__empty[y, x] = 1
 
         self.__update_weights()
 
@@ -135,17 +251,19 @@ class WeightDiffusionMapGenerator:
         """
         Randomly selects a wall square based on weights and 'digs it out'
         """
-        
-        flattened_weights = self.__weights.flatten(order='F').astype(float)
-        flattened_weights /= flattened_weights.sum()  # Normalize weights to probabilities
 
-        # Randomly select an index based on weights
-        chosen_index = np.random.choice(np.arange(len(flattened_weights)), p=flattened_weights)
+        # Randomly select an active slot based on weights, only the frontier is scanned instead of the whole grid
+        # The draw stays an integer, weights are integers too so no float conversion or rounding is involved
+        target = self.__rng.integers(self.__weight_sum)
+        active_weights = self.__active_weights[:self.__num_active]
+        if self.__num_active <= BLOCK_SIZE:
+            chosen_slot = sample_weighted(active_weights, target)
+        else:
+            chosen_slot = sample_weighted_blocks(active_weights, self.__block_weights, target)
+        chosen_index = self.__active_indices[chosen_slot]
 
         # Convert the flattened index to 2D coordinates
-        x, y = np.unravel_index(indices=chosen_index, shape=self.__weights.shape, order='F')
-
-        self.__current_position = Position(x, y)
+        self.__current_y, self.__current_x = divmod(int(chosen_index), self.__width)
 
         self.__dig()
 
@@ -153,14 +271,23 @@ class WeightDiffusionMapGenerator:
 w = 272
 h = 71
 
+# Frames are written as bytes to the buffered stdout and only flushed every few frames instead of on every print
+frames_per_flush = 10
+separator = b'|' * w + b'\n'
+output = sys.stdout.buffer
+
 generator = WeightDiffusionMapGenerator(w, h)
 
-print(generator)
+output.write(bytes(generator) + b'\n')
 
-for _ in range(2000):
+for i in range(2000):
     generator.next_dig()
 
-    print(generator)
-    # print(generator.weights)
-    print('|'*w)
+    output.write(bytes(generator) + b'\n')
+    # output.write(generator.weights.encode('ascii') + b'\n')
+    output.write(separator)
+    if i % frames_per_flush == frames_per_flush - 1:
+        output.flush()
     sleep(0)
+
+output.flush()